@@ -69,7 +69,8 @@ class Encoder(nn.Module):
         self.apply(utils.weight_init)
 
     def forward(self, obs):
-        obs = obs / 255.0 - 0.5
+        # pixels arrive as uint8, normalize on device into a single float copy
+        obs = obs.to(torch.float32, copy=True).div_(255.0).sub_(0.5)
         h = self.convnet(obs)
         h = h.view(h.shape[0], -1)
         return h
@@ -314,23 +315,30 @@ class EnsembleDDPGAgent:
     def update_meta(self, meta, global_step, time_step, finetune=False):
         return meta
 
-    def act(self, obs, meta, step, eval_mode):
-        obs = torch.as_tensor(obs, device=self.device).unsqueeze(0)
+    def act(self, obs, meta, step, eval_mode, actor=None):
+        # actor may be a compiled view of self.actor used for rollouts
+        actor = self.actor if actor is None else actor
+        obs = torch.as_tensor(obs, device=self.device)
+        # a leading env dim means a batch of observations from a vector env
+        batched = obs.dim() > len(self.obs_shape)
+        if not batched:
+            obs = obs.unsqueeze(0)
         h = self.encoder(obs)
         inputs = [h]
         for value in meta.values():
-            value = torch.as_tensor(value, device=self.device).unsqueeze(0)
-            inputs.append(value)
+            value = torch.as_tensor(value, device=self.device)
+            inputs.append(value if batched else value.unsqueeze(0))
         inpt = torch.cat(inputs, dim=-1)  # (1, 40)
         stddev = utils.schedule(self.stddev_schedule, step)
-        dist = self.actor(inpt, stddev)
+        dist = actor(inpt, stddev)
         if eval_mode:
             action = dist.mean
         else:
             action = dist.sample(clip=None)
             if step < self.num_expl_steps:
                 action.uniform_(-1.0, 1.0)
-        return action.cpu().numpy()[0]
+        action = action.cpu().numpy()
+        return action if batched else action[0]
 
     def update_critic(
         self, obs, skill, action, reward, discount, next_obs, step, mask=None
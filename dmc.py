@@ -1,4 +1,5 @@
-from collections import OrderedDict, deque
+import multiprocessing as mp
+from collections import OrderedDict
 from typing import Any, NamedTuple
 
 import dm_env
@@ -125,10 +126,19 @@ class ActionRepeatWrapper(dm_env.Environment):
 
 
 class FrameStackWrapper(dm_env.Environment):
+    """Stacks the last num_frames frames along the channel axis.
+
+    Frames live in a ring of 2 * num_frames slots and every frame is written
+    twice, so the stack is always a contiguous view of the ring and no copy is
+    made per step. Observations are only valid until the next step; every reset
+    starts a new ring, so the last one of an episode outlives the reset.
+    """
+
     def __init__(self, env, num_frames, pixels_key="pixels"):
         self._env = env
         self._num_frames = num_frames
-        self._frames = deque([], maxlen=num_frames)
+        self._frames = None
+        self._next = 0
         self._pixels_key = pixels_key
 
         wrapped_obs_spec = env.observation_spec()
@@ -149,8 +159,8 @@ class FrameStackWrapper(dm_env.Environment):
         )
 
     def _transform_observation(self, time_step):
-        assert len(self._frames) == self._num_frames
-        obs = np.concatenate(list(self._frames), axis=0)
+        frames = self._frames[self._next : self._next + self._num_frames]
+        obs = frames.reshape((-1,) + frames.shape[2:])
         return time_step._replace(observation=obs)
 
     def _extract_pixels(self, time_step):
@@ -158,19 +168,26 @@ class FrameStackWrapper(dm_env.Environment):
         # remove batch dim
         if len(pixels.shape) == 4:
             pixels = pixels[0]
-        return pixels.transpose(2, 0, 1).copy()
+        return pixels.transpose(2, 0, 1)
+
+    def _push(self, pixels):
+        self._frames[self._next] = pixels
+        self._frames[self._next + self._num_frames] = pixels
+        self._next = (self._next + 1) % self._num_frames
 
     def reset(self):
         time_step = self._env.reset()
         pixels = self._extract_pixels(time_step)
-        for _ in range(self._num_frames):
-            self._frames.append(pixels)
+        self._frames = np.empty(
+            (2 * self._num_frames,) + pixels.shape, dtype=pixels.dtype
+        )
+        self._frames[:] = pixels
+        self._next = 0
         return self._transform_observation(time_step)
 
     def step(self, action):
         time_step = self._env.step(action)
-        pixels = self._extract_pixels(time_step)
-        self._frames.append(pixels)
+        self._push(self._extract_pixels(time_step))
         return self._transform_observation(time_step)
 
     def observation_spec(self):
@@ -329,3 +346,179 @@ def make(name, obs_type, frame_stack, action_repeat, seed):
     env = action_scale.Wrapper(env, minimum=-1.0, maximum=+1.0)
     env = ExtendedTimeStepWrapper(env)
     return env
+
+
+class StepAndMaybeReset(dm_env.Environment):
+    """Adds `step_and_maybe_reset`, which resets the env right after a final
+    step, so that both time steps are returned by a single call."""
+
+    def __init__(self, env):
+        self._env = env
+
+    def step_and_maybe_reset(self, action):
+        # returns the step's time step, the time step to act from next and
+        # whether the env was reset in between
+        time_step = self._env.step(action)
+        if time_step.last():
+            return time_step, self._env.reset(), True
+        return time_step, time_step, False
+
+    def reset(self):
+        return self._env.reset()
+
+    def step(self, action):
+        return self._env.step(action)
+
+    def observation_spec(self):
+        return self._env.observation_spec()
+
+    def action_spec(self):
+        return self._env.action_spec()
+
+    def __getattr__(self, name):
+        return getattr(self._env, name)
+
+
+def _worker(remote, parent_remote, env_fn):
+    parent_remote.close()
+    env = StepAndMaybeReset(env_fn())
+    try:
+        while True:
+            cmd, data = remote.recv()
+            if cmd == "step":
+                remote.send(env.step(data))
+            elif cmd == "step_and_maybe_reset":
+                remote.send(env.step_and_maybe_reset(data))
+            elif cmd == "reset":
+                remote.send(env.reset())
+            elif cmd == "call":
+                name, args, kwargs = data
+                fn = env
+                for attr in name.split("."):
+                    fn = getattr(fn, attr)
+                remote.send(fn(*args, **kwargs))
+            elif cmd == "close":
+                break
+            else:
+                raise NotImplementedError(cmd)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        remote.close()
+
+
+class _RemoteAttr:
+    """A dotted attribute of one remote env, e.g. "physics.render"."""
+
+    def __init__(self, vector_env, index, name):
+        self._vector_env = vector_env
+        self._index = index
+        self._name = name
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return _RemoteAttr(self._vector_env, self._index, f"{self._name}.{name}")
+
+    def __call__(self, *args, **kwargs):
+        return self._vector_env.call(
+            self._name, *args, indices=[self._index], **kwargs
+        )[0]
+
+
+class _EnvHandle:
+    """One env of an AsyncVectorEnv, used like a local dm_env."""
+
+    def __init__(self, vector_env, index):
+        self._vector_env = vector_env
+        self._index = index
+
+    def reset(self):
+        return self._vector_env.reset([self._index])[0]
+
+    def step(self, action):
+        return self._vector_env.step([action], [self._index])[0]
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return _RemoteAttr(self._vector_env, self._index, name)
+
+
+class AsyncVectorEnv:
+    """Steps a batch of environments, each living in its own subprocess.
+
+    Time steps are returned as lists indexed by env. Envs are not reset
+    automatically: call `reset` with the indices of finished envs, or step
+    with `step_and_maybe_reset`. `envs` holds a handle per env that can be
+    used like a single local env.
+    """
+
+    def __init__(self, env_fns):
+        self.num_envs = len(env_fns)
+        self._remotes, work_remotes = zip(*[mp.Pipe() for _ in env_fns])
+        self._processes = []
+        for remote, work_remote, env_fn in zip(self._remotes, work_remotes, env_fns):
+            process = mp.Process(
+                target=_worker, args=(work_remote, remote, env_fn), daemon=True
+            )
+            process.start()
+            work_remote.close()
+            self._processes.append(process)
+        self.envs = [_EnvHandle(self, i) for i in range(self.num_envs)]
+        self._obs_spec = None
+        self._action_spec = None
+        self._closed = False
+
+    def _indices(self, indices):
+        return range(self.num_envs) if indices is None else indices
+
+    def step(self, actions, indices=None):
+        indices = self._indices(indices)
+        assert len(actions) == len(indices)
+        for i, action in zip(indices, actions):
+            self._remotes[i].send(("step", action))
+        return [self._remotes[i].recv() for i in indices]
+
+    def step_and_maybe_reset(self, actions, indices=None):
+        # finished envs are reset in the same round trip as their last step
+        indices = self._indices(indices)
+        assert len(actions) == len(indices)
+        for i, action in zip(indices, actions):
+            self._remotes[i].send(("step_and_maybe_reset", action))
+        return [self._remotes[i].recv() for i in indices]
+
+    def reset(self, indices=None):
+        indices = self._indices(indices)
+        for i in indices:
+            self._remotes[i].send(("reset", None))
+        return [self._remotes[i].recv() for i in indices]
+
+    def call(self, name, *args, indices=None, **kwargs):
+        indices = self._indices(indices)
+        for i in indices:
+            self._remotes[i].send(("call", (name, args, kwargs)))
+        return [self._remotes[i].recv() for i in indices]
+
+    def observation_spec(self):
+        if self._obs_spec is None:
+            self._obs_spec = self.call("observation_spec", indices=[0])[0]
+        return self._obs_spec
+
+    def action_spec(self):
+        if self._action_spec is None:
+            self._action_spec = self.call("action_spec", indices=[0])[0]
+        return self._action_spec
+
+    def close(self):
+        if self._closed:
+            return
+        for remote in self._remotes:
+            try:
+                remote.send(("close", None))
+            except (BrokenPipeError, EOFError):
+                # the worker is already gone, e.g. after a KeyboardInterrupt
+                pass
+        for process in self._processes:
+            process.join()
+        self._closed = True
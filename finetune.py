@@ -14,6 +14,7 @@ if torch.cuda.is_available():
     else:
         os.environ["MUJOCO_GL"] = "glfw"
 
+from functools import partial
 from pathlib import Path
 
 import hydra
@@ -54,14 +55,7 @@ class Workspace:
             self.device = torch.device("cpu")
             cfg.device = "cpu"
 
-        config = {}
-
-        for k, v in cfg.items():
-            if isinstance(v, dict):
-                for kk, vv in v.items():
-                    config[k + "." + kk] = vv
-            else:
-                config[k] = v
+        config = utils.flatten_config(cfg)
 
         if cfg.use_wandb:
             exp_name = "_".join(
@@ -80,18 +74,40 @@ class Workspace:
         # create logger
         self.logger = Logger(self.work_dir, use_tb=cfg.use_tb, use_wandb=cfg.use_wandb)
         # create envs
-        self.train_env = dmc.make(
-            cfg.task, cfg.obs_type, cfg.frame_stack, cfg.action_repeat, cfg.seed
+        self.train_envs = dmc.AsyncVectorEnv(
+            [
+                partial(
+                    dmc.make,
+                    cfg.task,
+                    cfg.obs_type,
+                    cfg.frame_stack,
+                    cfg.action_repeat,
+                    cfg.seed + i,
+                )
+                for i in range(cfg.num_envs)
+            ]
         )
-        self.eval_env = dmc.make(
-            cfg.task, cfg.obs_type, cfg.frame_stack, cfg.action_repeat, cfg.seed
+        # the eval env lives in its own worker too, so that its MuJoCo start-up
+        # overlaps with the train envs instead of blocking here
+        self.eval_envs = dmc.AsyncVectorEnv(
+            [
+                partial(
+                    dmc.make,
+                    cfg.task,
+                    cfg.obs_type,
+                    cfg.frame_stack,
+                    cfg.action_repeat,
+                    cfg.seed,
+                )
+            ]
         )
+        self.eval_env = self.eval_envs.envs[0]
 
         # create agent
         self.agent = make_agent(
             cfg.obs_type,
-            self.train_env.observation_spec(),
-            self.train_env.action_spec(),
+            self.train_envs.observation_spec(),
+            self.train_envs.action_spec(),
             cfg.num_seed_frames // cfg.action_repeat,
             cfg.agent,
         )
@@ -101,12 +117,25 @@ class Workspace:
             pretrained_agent = self.load_snapshot()["agent"]
             self.agent.init_from(pretrained_agent)
 
+        # rollouts run a compiled view of the actor, parameters stay shared;
+        # obs shapes are fixed for a run, so kernels are specialized to them
+        self.rollout_actor = utils.compile_module(self.agent.actor, dynamic=False)
+        if self.device.type == "cuda":
+            self.rollout_actor = utils.graph_actor(self.rollout_actor)
+        utils.warmup_actor(
+            self.agent,
+            self.rollout_actor,
+            self.train_envs.observation_spec(),
+            (cfg.num_envs, 1),
+            cfg.use_amp,
+        )
+
         # get meta specs
         meta_specs = self.agent.get_meta_specs()
         # create replay buffer
         data_specs = (
-            self.train_env.observation_spec(),
-            self.train_env.action_spec(),
+            self.train_envs.observation_spec(),
+            self.train_envs.action_spec(),
             specs.Array((1,), np.float32, "reward"),
             specs.Array((1,), np.float32, "discount"),
         )
@@ -125,6 +154,8 @@ class Workspace:
             False,
             cfg.nstep,
             cfg.discount,
+            # batches are staged in pinned buffers by utils.PrefetchIterator
+            pin_memory=False,
         )
         self._replay_iter = None
 
@@ -153,31 +184,39 @@ class Workspace:
     @property
     def replay_iter(self):
         if self._replay_iter is None:
-            self._replay_iter = iter(self.replay_loader)
+            self._replay_iter = utils.PrefetchIterator(
+                self.replay_loader, num_prefetch=4, device=self.device
+            )
         return self._replay_iter
 
     def eval(self):
         step, episode, total_reward = 0, 0, 0
         eval_until_episode = utils.Until(self.cfg.num_eval_episodes)
         meta = self.agent.init_meta()
-        while eval_until_episode(episode):
-            time_step = self.eval_env.reset()
-            if self.cfg.save_video:
-                self.video_recorder.init(self.eval_env, enabled=(episode == 0))
-            while not time_step.last():
-                with torch.no_grad(), utils.eval_mode(self.agent):
+        with torch.inference_mode(), utils.eval_mode(self.agent), utils.autocast(
+            self.cfg.use_amp, cache_enabled=False
+        ):
+            while eval_until_episode(episode):
+                time_step = self.eval_env.reset()
+                if self.cfg.save_video:
+                    self.video_recorder.init(self.eval_env, enabled=(episode == 0))
+                while not time_step.last():
                     action = self.agent.act(
-                        time_step.observation, meta, self.global_step, eval_mode=True
+                        time_step.observation,
+                        meta,
+                        self.global_step,
+                        eval_mode=True,
+                        actor=self.rollout_actor,
                     )
-                time_step = self.eval_env.step(action)
-                if self.cfg.save_video:
-                    self.video_recorder.record(self.eval_env)
-                total_reward += time_step.reward
-                step += 1
+                    time_step = self.eval_env.step(action)
+                    if self.cfg.save_video:
+                        self.video_recorder.record(self.eval_env)
+                    total_reward += time_step.reward
+                    step += 1
 
-            episode += 1
-            if self.cfg.save_video:
-                self.video_recorder.save(f"{self.global_frame}.mp4")
+                episode += 1
+                if self.cfg.save_video:
+                    self.video_recorder.save(f"{self.global_frame}.mp4")
 
         with self.logger.log_and_dump_ctx(self.global_frame, ty="eval") as log:
             log("episode_reward", total_reward / episode)
@@ -187,6 +226,107 @@ class Workspace:
             if "skill" in meta.keys():
                 log("skill", meta["skill"].argmax())
 
+    def _collect(self, num_steps, eval_every_step):
+        # steps all train envs num_steps times and stores the transitions
+        # one inference context per block instead of one per step
+        with torch.inference_mode(), utils.eval_mode(self.agent), utils.autocast(
+            self.cfg.use_amp, cache_enabled=False
+        ):
+            for _ in range(num_steps):
+                # resample skills on each env's own clock
+                for i, time_step in enumerate(self._time_steps):
+                    self._metas[i] = self.agent.update_meta(
+                        self._metas[i], self._episode_step[i], time_step
+                    )
+                meta = {
+                    key: np.stack([m[key] for m in self._metas])
+                    for key in self._metas[0]
+                }
+                # sample actions for all envs in one batched forward pass
+                actions = self.agent.act(
+                    np.stack([time_step.observation for time_step in self._time_steps]),
+                    meta,
+                    self.global_step,
+                    eval_mode=False,
+                    actor=self.rollout_actor,
+                )
+
+                # take env steps
+                # finished envs come back already reset
+                transitions = self.train_envs.step_and_maybe_reset(actions)
+                # episode stats of all envs advance in one vectorized update
+                self._episode_reward += [
+                    time_step.reward for time_step, _, _ in transitions
+                ]
+                self._episode_step += 1
+                for i, (time_step, next_time_step, _) in enumerate(transitions):
+                    # try to evaluate
+                    if eval_every_step(self.global_step):
+                        self.logger.log(
+                            "eval_total_time",
+                            self.timer.total_time(),
+                            self.global_frame,
+                        )
+                        self.eval()
+
+                    self.replay_storage.add(time_step, self._metas[i], i)
+                    if self.cfg.save_train_video and i == 0:
+                        self.train_video_recorder.record(time_step.observation)
+                    self._global_step += 1
+                    self._time_steps[i] = time_step
+
+                    if time_step.last():
+                        self._global_episode += 1
+                        if self.cfg.save_train_video and i == 0:
+                            self.train_video_recorder.save(f"{self.global_frame}.mp4")
+                        # wait until all the metrics schema is populated
+                        if self._metrics is not None:
+                            # log stats
+                            elapsed_time, total_time = self.timer.reset()
+                            elapsed_frame = (
+                                self.global_step - self._last_log_step
+                            ) * self.cfg.action_repeat
+                            self._last_log_step = self.global_step
+                            episode_frame = (
+                                self._episode_step[i] * self.cfg.action_repeat
+                            )
+                            with self.logger.log_and_dump_ctx(
+                                self.global_frame, ty="train"
+                            ) as log:
+                                log("fps", elapsed_frame / elapsed_time)
+                                log("total_time", total_time)
+                                log("episode_reward", float(self._episode_reward[i]))
+                                log("episode_length", episode_frame)
+                                log("episode", self.global_episode)
+                                log("buffer_size", len(self.replay_storage))
+                                log("step", self.global_step)
+
+                        # the env was reset along with its last step
+                        self._time_steps[i] = next_time_step
+                        self._metas[i] = self.agent.init_meta()
+                        self.replay_storage.add(self._time_steps[i], self._metas[i], i)
+                        if self.cfg.save_train_video and i == 0:
+                            self.train_video_recorder.init(
+                                self._time_steps[i].observation
+                            )
+
+                        self._episode_step[i] = 0
+                        self._episode_reward[i] = 0
+
+    def _update(self, start_step, end_step, seed_until_step):
+        # one agent update per env step in [start_step, end_step)
+        for step in range(start_step, end_step):
+            if seed_until_step(step):
+                continue
+            with utils.autocast(self.cfg.use_amp):
+                metrics = self.agent.update(self.replay_iter, step)
+            self.logger.log_metrics(metrics, step * self.cfg.action_repeat, ty="train")
+            if self.cfg.use_wandb and metrics:
+                self._wandb_metrics.add(metrics)
+                if len(self._wandb_metrics) >= self.cfg.wandb_flush_every:
+                    wandb.log(self._wandb_metrics.pop_mean())
+            self._metrics = metrics
+
     def train(self):
         # predicates
         train_until_step = utils.Until(
@@ -197,74 +337,36 @@ class Workspace:
             self.cfg.eval_every_frames, self.cfg.action_repeat
         )
 
-        episode_step, episode_reward = 0, 0
-        time_step = self.train_env.reset()
-        meta = self.agent.init_meta()
-        self.replay_storage.add(time_step, meta)
+        num_envs = self.train_envs.num_envs
+        self._episode_step = np.zeros(num_envs, dtype=np.int64)
+        self._episode_reward = np.zeros(num_envs, dtype=np.float64)
+        self._time_steps = utils.stagger_resets(
+            self.train_envs, self.cfg.stagger_frames // self.cfg.action_repeat
+        )
+        self._metas = [self.agent.init_meta() for _ in range(num_envs)]
+        for i, time_step in enumerate(self._time_steps):
+            self.replay_storage.add(time_step, self._metas[i], i)
+        # only the first env is recorded
         if self.cfg.save_train_video:
-            self.train_video_recorder.init(time_step.observation)
-        metrics = None
-        while train_until_step(self.global_step):
-            if time_step.last():
-                self._global_episode += 1
-                if self.cfg.save_train_video:
-                    self.train_video_recorder.save(f"{self.global_frame}.mp4")
-                # wait until all the metrics schema is populated
-                if metrics is not None:
-                    # log stats
-                    elapsed_time, total_time = self.timer.reset()
-                    episode_frame = episode_step * self.cfg.action_repeat
-                    with self.logger.log_and_dump_ctx(
-                        self.global_frame, ty="train"
-                    ) as log:
-                        log("fps", episode_frame / elapsed_time)
-                        log("total_time", total_time)
-                        log("episode_reward", episode_reward)
-                        log("episode_length", episode_frame)
-                        log("episode", self.global_episode)
-                        log("buffer_size", len(self.replay_storage))
-                        log("step", self.global_step)
-
-                # reset env
-                time_step = self.train_env.reset()
-                meta = self.agent.init_meta()
-                self.replay_storage.add(time_step, meta)
-                if self.cfg.save_train_video:
-                    self.train_video_recorder.init(time_step.observation)
-
-                episode_step = 0
-                episode_reward = 0
-
-            # try to evaluate
-            if eval_every_step(self.global_step):
-                self.logger.log(
-                    "eval_total_time", self.timer.total_time(), self.global_frame
-                )
-                self.eval()
-
-            meta = self.agent.update_meta(meta, self.global_step, time_step)
-
-            # sample action
-            with torch.no_grad(), utils.eval_mode(self.agent):
-                action = self.agent.act(
-                    time_step.observation, meta, self.global_step, eval_mode=False
-                )
-
-            # try to update the agent
-            if not seed_until_step(self.global_step):
-                metrics = self.agent.update(self.replay_iter, self.global_step)
-                self.logger.log_metrics(metrics, self.global_frame, ty="train")
-                if self.cfg.use_wandb:
-                    wandb.log(metrics)
-
-            # take env step
-            time_step = self.train_env.step(action)
-            episode_reward += time_step.reward
-            self.replay_storage.add(time_step, meta)
-            if self.cfg.save_train_video:
-                self.train_video_recorder.record(time_step.observation)
-            episode_step += 1
-            self._global_step += 1
+            self.train_video_recorder.init(self._time_steps[0].observation)
+        self._metrics = None
+        self._wandb_metrics = utils.MetricsBuffer()
+        self._last_log_step = self.global_step
+        try:
+            while train_until_step(self.global_step):
+                # collect a block of env steps, then run the matching updates
+                start_step = self.global_step
+                self._collect(self.cfg.steps_per_update_block, eval_every_step)
+                self._update(start_step, self.global_step, seed_until_step)
+        finally:
+            # env workers would otherwise outlive the run, e.g. under hydra -m
+            self.train_envs.close()
+            self.eval_envs.close()
+            if len(self._wandb_metrics) > 0:
+                wandb.log(self._wandb_metrics.pop_mean())
+        # the episode started last is never saved
+        if self.cfg.save_train_video:
+            self.train_video_recorder.close()
 
     def load_snapshot(self):
         snapshot_base_dir = Path(self.cfg.snapshot_base_dir)
@@ -286,9 +388,7 @@ class Workspace:
             if not snapshot.exists():
                 logging.error("no such a pretrain model")
                 return None
-            with snapshot.open("rb") as f:
-                payload = torch.load(f, map_location="cuda:0")
-            return payload
+            return utils.load_snapshot_payload(snapshot)
 
         # try to load current seed
         payload = try_load(self.cfg.seed)
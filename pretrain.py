@@ -12,6 +12,8 @@ if torch.cuda.is_available():
     else:
         os.environ["MUJOCO_GL"] = "glfw"
 
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
 
 import hydra
@@ -52,14 +54,7 @@ class Workspace:
             self.device = torch.device("cpu")
             cfg.device = "cpu"
 
-        config = {}
-
-        for k, v in cfg.items():
-            if isinstance(v, dict):
-                for kk, vv in v.items():
-                    config[k + "." + kk] = vv
-            else:
-                config[k] = v
+        config = utils.flatten_config(cfg)
 
         # create logger
         if cfg.use_wandb:
@@ -83,36 +78,63 @@ class Workspace:
             self.cfg.domain in PRIMAL_TASKS
         ), f"{self.cfg.domain} not in {PRIMAL_TASKS}"
 
-        self.train_env = dmc.make(
-            PRIMAL_TASKS[self.cfg.domain],
-            cfg.obs_type,
-            cfg.frame_stack,
-            cfg.action_repeat,
-            cfg.seed,
+        self.train_envs = dmc.AsyncVectorEnv(
+            [
+                partial(
+                    dmc.make,
+                    PRIMAL_TASKS[self.cfg.domain],
+                    cfg.obs_type,
+                    cfg.frame_stack,
+                    cfg.action_repeat,
+                    cfg.seed + i,
+                )
+                for i in range(cfg.num_envs)
+            ]
         )
-        self.eval_env = dmc.make(
-            PRIMAL_TASKS[self.cfg.domain],
-            cfg.obs_type,
-            cfg.frame_stack,
-            cfg.action_repeat,
-            cfg.seed,
+        # the eval env lives in its own worker too, so that its MuJoCo start-up
+        # overlaps with the train envs instead of blocking here
+        self.eval_envs = dmc.AsyncVectorEnv(
+            [
+                partial(
+                    dmc.make,
+                    PRIMAL_TASKS[self.cfg.domain],
+                    cfg.obs_type,
+                    cfg.frame_stack,
+                    cfg.action_repeat,
+                    cfg.seed,
+                )
+            ]
         )
+        self.eval_env = self.eval_envs.envs[0]
 
         # create agent
         self.agent = make_agent(
             cfg.obs_type,
-            self.train_env.observation_spec(),
-            self.train_env.action_spec(),
+            self.train_envs.observation_spec(),
+            self.train_envs.action_spec(),
             cfg.num_seed_frames // cfg.action_repeat,
             cfg.agent,
         )
 
+        # rollouts run a compiled view of the actor, parameters stay shared;
+        # obs shapes are fixed for a run, so kernels are specialized to them
+        self.rollout_actor = utils.compile_module(self.agent.actor, dynamic=False)
+        if self.device.type == "cuda":
+            self.rollout_actor = utils.graph_actor(self.rollout_actor)
+        utils.warmup_actor(
+            self.agent,
+            self.rollout_actor,
+            self.train_envs.observation_spec(),
+            (cfg.num_envs, 1),
+            cfg.use_amp,
+        )
+
         # get meta specs
         meta_specs = self.agent.get_meta_specs()
         # create replay buffer
         data_specs = (
-            self.train_env.observation_spec(),
-            self.train_env.action_spec(),
+            self.train_envs.observation_spec(),
+            self.train_envs.action_spec(),
             specs.Array((1,), np.float32, "reward"),
             specs.Array((1,), np.float32, "discount"),
         )
@@ -131,9 +153,15 @@ class Workspace:
             False,
             cfg.nstep,
             cfg.discount,
+            # batches are staged in pinned buffers by utils.PrefetchIterator
+            pin_memory=False,
         )
         self._replay_iter = None
 
+        # snapshots are written by a background thread while training goes on
+        self._save_pool = ThreadPoolExecutor(max_workers=1)
+        self._save_future = None
+
         self.timer = utils.Timer()
         self._global_step = 0
         self._global_episode = 0
@@ -153,25 +181,33 @@ class Workspace:
     @property
     def replay_iter(self):
         if self._replay_iter is None:
-            self._replay_iter = iter(self.replay_loader)
+            self._replay_iter = utils.PrefetchIterator(
+                self.replay_loader, num_prefetch=4, device=self.device
+            )
         return self._replay_iter
 
     def eval(self):
         step, episode, total_reward = 0, 0, 0
         eval_until_episode = utils.Until(self.cfg.num_eval_episodes)
         meta = self.agent.init_meta()
-        while eval_until_episode(episode):
-            time_step = self.eval_env.reset()
-            while not time_step.last():
-                with torch.no_grad(), utils.eval_mode(self.agent):
+        with torch.inference_mode(), utils.eval_mode(self.agent), utils.autocast(
+            self.cfg.use_amp, cache_enabled=False
+        ):
+            while eval_until_episode(episode):
+                time_step = self.eval_env.reset()
+                while not time_step.last():
                     action = self.agent.act(
-                        time_step.observation, meta, self.global_step, eval_mode=True
+                        time_step.observation,
+                        meta,
+                        self.global_step,
+                        eval_mode=True,
+                        actor=self.rollout_actor,
                     )
-                time_step = self.eval_env.step(action)
-                total_reward += time_step.reward
-                step += 1
+                    time_step = self.eval_env.step(action)
+                    total_reward += time_step.reward
+                    step += 1
 
-            episode += 1
+                episode += 1
 
         with self.logger.log_and_dump_ctx(self.global_frame, ty="eval") as log:
             log("episode_reward", total_reward / episode)
@@ -179,6 +215,102 @@ class Workspace:
             log("episode", self.global_episode)
             log("step", self.global_step)
 
+    def _collect(self, num_steps, eval_every_step):
+        # steps all train envs num_steps times and stores the transitions
+        # one inference context per block instead of one per step
+        with torch.inference_mode(), utils.eval_mode(self.agent), utils.autocast(
+            self.cfg.use_amp, cache_enabled=False
+        ):
+            for _ in range(num_steps):
+                # resample skills on each env's own clock
+                for i, time_step in enumerate(self._time_steps):
+                    self._metas[i] = self.agent.update_meta(
+                        self._metas[i], self._episode_step[i], time_step
+                    )
+                meta = {
+                    key: np.stack([m[key] for m in self._metas])
+                    for key in self._metas[0]
+                }
+                # sample actions for all envs in one batched forward pass
+                actions = self.agent.act(
+                    np.stack([time_step.observation for time_step in self._time_steps]),
+                    meta,
+                    self.global_step,
+                    eval_mode=False,
+                    actor=self.rollout_actor,
+                )
+
+                # take env steps
+                # finished envs come back already reset
+                transitions = self.train_envs.step_and_maybe_reset(actions)
+                # episode stats of all envs advance in one vectorized update
+                self._episode_reward += [
+                    time_step.reward for time_step, _, _ in transitions
+                ]
+                self._episode_step += 1
+                for i, (time_step, next_time_step, _) in enumerate(transitions):
+                    if self.global_frame in self.cfg.snapshots:
+                        self.save_snapshot()
+
+                    # try to evaluate
+                    if eval_every_step(self.global_step):
+                        self.logger.log(
+                            "eval_total_time",
+                            self.timer.total_time(),
+                            self.global_frame,
+                        )
+                        self.eval()
+
+                    self.replay_storage.add(time_step, self._metas[i], i)
+                    self._global_step += 1
+                    self._time_steps[i] = time_step
+
+                    if time_step.last():
+                        self._global_episode += 1
+                        # self.train_video_recorder.save(f'{self.global_frame}.mp4')
+                        # wait until all the metrics schema is populated
+                        if self._metrics is not None:
+                            # log stats
+                            elapsed_time, total_time = self.timer.reset()
+                            elapsed_frame = (
+                                self.global_step - self._last_log_step
+                            ) * self.cfg.action_repeat
+                            self._last_log_step = self.global_step
+                            episode_frame = (
+                                self._episode_step[i] * self.cfg.action_repeat
+                            )
+                            with self.logger.log_and_dump_ctx(
+                                self.global_frame, ty="train"
+                            ) as log:
+                                log("fps", elapsed_frame / elapsed_time)
+                                log("total_time", total_time)
+                                log("episode_reward", float(self._episode_reward[i]))
+                                log("episode_length", episode_frame)
+                                log("episode", self.global_episode)
+                                log("buffer_size", len(self.replay_storage))
+                                log("step", self.global_step)
+
+                        # the env was reset along with its last step
+                        self._time_steps[i] = next_time_step
+                        self._metas[i] = self.agent.init_meta()
+                        self.replay_storage.add(self._time_steps[i], self._metas[i], i)
+                        self._episode_step[i] = 0
+                        self._episode_reward[i] = 0
+
+    def _update(self, start_step, end_step, seed_until_step):
+        # one agent update per env step in [start_step, end_step)
+        for step in range(start_step, end_step):
+            if seed_until_step(step):
+                continue
+            with utils.autocast(self.cfg.use_amp):
+                metrics = self.agent.update(self.replay_iter, step)
+            self.logger.log_metrics(metrics, step * self.cfg.action_repeat, ty="train")
+            if self.cfg.use_wandb and metrics:
+                self._wandb_metrics.add(metrics)
+                if len(self._wandb_metrics) >= self.cfg.wandb_flush_every:
+                    wandb.log(self._wandb_metrics.pop_mean())
+            self._metrics = metrics
+
     def train(self):
         # predicates
         train_until_step = utils.Until(
@@ -189,77 +321,38 @@ class Workspace:
             self.cfg.eval_every_frames, self.cfg.action_repeat
         )
 
-        episode_step, episode_reward = 0, 0
-        time_step = self.train_env.reset()
-        meta = self.agent.init_meta()
-        self.replay_storage.add(time_step, meta)
+        num_envs = self.train_envs.num_envs
+        self._episode_step = np.zeros(num_envs, dtype=np.int64)
+        self._episode_reward = np.zeros(num_envs, dtype=np.float64)
+        self._time_steps = utils.stagger_resets(
+            self.train_envs, self.cfg.stagger_frames // self.cfg.action_repeat
+        )
+        self._metas = [self.agent.init_meta() for _ in range(num_envs)]
+        for i, time_step in enumerate(self._time_steps):
+            self.replay_storage.add(time_step, self._metas[i], i)
         # self.train_video_recorder.init(time_step.observation)
-        metrics = None
-        while train_until_step(self.global_step):
-            if time_step.last():
-                self._global_episode += 1
-                # self.train_video_recorder.save(f'{self.global_frame}.mp4')
-                # wait until all the metrics schema is populated
-                if metrics is not None:
-                    # log stats
-                    elapsed_time, total_time = self.timer.reset()
-                    episode_frame = episode_step * self.cfg.action_repeat
-                    with self.logger.log_and_dump_ctx(
-                        self.global_frame, ty="train"
-                    ) as log:
-                        log("fps", episode_frame / elapsed_time)
-                        log("total_time", total_time)
-                        log("episode_reward", episode_reward)
-                        log("episode_length", episode_frame)
-                        log("episode", self.global_episode)
-                        log("buffer_size", len(self.replay_storage))
-                        log("step", self.global_step)
-
-                # reset env
-                time_step = self.train_env.reset()
-                meta = self.agent.init_meta()
-                self.replay_storage.add(time_step, meta)
-                # try to save snapshot
-                episode_step = 0
-                episode_reward = 0
-
-            if self.global_frame in self.cfg.snapshots:
-                self.save_snapshot()
-
-            # try to evaluate
-            if eval_every_step(self.global_step):
-                self.logger.log(
-                    "eval_total_time", self.timer.total_time(), self.global_frame
-                )
-                self.eval()
-
-            meta = self.agent.update_meta(meta, self.global_step, time_step)
-            # sample action
-            with torch.no_grad(), utils.eval_mode(self.agent):
-                action = self.agent.act(
-                    time_step.observation, meta, self.global_step, eval_mode=False
-                )
-
-            # try to update the agent
-            if not seed_until_step(self.global_step):
-                metrics = self.agent.update(self.replay_iter, self.global_step)
-                self.logger.log_metrics(metrics, self.global_frame, ty="train")
-                if self.cfg.use_wandb:
-                    wandb.log(metrics)
-
-            # take env step
-            time_step = self.train_env.step(action)
-            episode_reward += time_step.reward
-            self.replay_storage.add(time_step, meta)
-            episode_step += 1
-            self._global_step += 1
+        self._metrics = None
+        self._wandb_metrics = utils.MetricsBuffer()
+        self._last_log_step = self.global_step
+        try:
+            while train_until_step(self.global_step):
+                # collect a block of env steps, then run the matching updates
+                start_step = self.global_step
+                self._collect(self.cfg.steps_per_update_block, eval_every_step)
+                self._update(start_step, self.global_step, seed_until_step)
+        finally:
+            # env workers would otherwise outlive the run, e.g. under hydra -m
+            self.train_envs.close()
+            self.eval_envs.close()
+            if len(self._wandb_metrics) > 0:
+                wandb.log(self._wandb_metrics.pop_mean())
 
         self.save_snapshot()
+        self.wait_for_snapshot()
 
     def load_snapshot(self):
         snapshot_file = Path(self.cfg.snapshot)
-        with snapshot_file.open("rb") as f:
-            payload = torch.load(f, map_location=self.cfg.device)
+        payload = utils.load_snapshot_payload(snapshot_file)
         self.agent.init_from(payload["agent"])
         self.cfg.num_seed_frames = payload["_global_step"] / 10
         self.cfg.num_train_frames -= payload["_global_step"] + self.cfg.num_seed_frames
@@ -272,10 +365,28 @@ class Workspace:
         snapshot = snapshot_dir / f"snapshot_{self.global_frame}.pt"
         print(snapshot)
         keys_to_save = ["agent", "_global_step", "_global_episode"]
-        payload = {k: self.__dict__[k] for k in keys_to_save}
+        # at most one snapshot is pending, the payload is a host copy so that
+        # training can go on while it is written without holding a second copy
+        # of the agent on the device; the copy is made outside of the
+        # inference mode that rollouts may call this from
+        self.wait_for_snapshot()
+        with torch.inference_mode(False):
+            payload = utils.host_copy({k: self.__dict__[k] for k in keys_to_save})
+        self._save_future = self._save_pool.submit(
+            self._write_snapshot, payload, snapshot
+        )
+
+    @staticmethod
+    def _write_snapshot(payload, snapshot):
         with snapshot.open("wb") as f:
             torch.save(payload, f)
 
+    def wait_for_snapshot(self):
+        # blocks until the pending snapshot is written, raising its error
+        if self._save_future is not None:
+            self._save_future.result()
+            self._save_future = None
+
 
 @hydra.main(config_path=".", config_name="pretrain")
 def main(cfg):
@@ -291,6 +402,7 @@ def main(cfg):
     except KeyboardInterrupt:
         print("interrupted")
         workspace.save_snapshot()
+        workspace.wait_for_snapshot()
         exit()
 
 
@@ -2,14 +2,28 @@ import datetime
 import io
 import random
 import traceback
-from collections import defaultdict
 
 import numpy as np
 import torch
 import torch.nn as nn
+from numba import njit
 from torch.utils.data import IterableDataset
 
 
+@njit(cache=True, fastmath=True)
+def _nstep_return(rewards, discounts, gamma):
+    reward = np.zeros_like(rewards[0])
+    discount = np.ones_like(discounts[0])
+    for i in range(rewards.shape[0]):
+        reward += discount * rewards[i]
+        discount *= discounts[i] * gamma
+    return reward, discount
+
+
+# compile once at import so that replay workers never pay for it
+_nstep_return(np.zeros((1, 1), np.float32), np.ones((1, 1), np.float32), np.float32(1))
+
+
 def episode_len(episode):
     # subtract -1 because the dummy first transition
     return next(iter(episode.values())).shape[0] - 1
@@ -30,37 +44,72 @@ def load_episode(fn):
         return episode
 
 
+class EpisodeBuffer:
+    """An episode in progress, stored as one preallocated array per field."""
+
+    def __init__(self, data_specs, meta_specs, capacity=1024):
+        self._data_specs = data_specs
+        self._meta_specs = meta_specs
+        self._buffers = {
+            spec.name: np.empty((capacity,) + tuple(spec.shape), spec.dtype)
+            for spec in data_specs + meta_specs
+        }
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def _grow(self):
+        for name, buffer in self._buffers.items():
+            grown = np.empty((2 * buffer.shape[0],) + buffer.shape[1:], buffer.dtype)
+            grown[: self._len] = buffer[: self._len]
+            self._buffers[name] = grown
+
+    def add(self, time_step, meta):
+        idx = self._len
+        if idx == next(iter(self._buffers.values())).shape[0]:
+            self._grow()
+        for spec in self._data_specs:
+            value = time_step[spec.name]
+            if not np.isscalar(value):
+                assert spec.shape == value.shape and spec.dtype == value.dtype
+            self._buffers[spec.name][idx] = value
+        for spec in self._meta_specs:
+            self._buffers[spec.name][idx] = meta[spec.name]
+        self._len += 1
+
+    def episode(self):
+        # views into the buffers, only valid until the next reset
+        return {name: buffer[: self._len] for name, buffer in self._buffers.items()}
+
+    def reset(self):
+        self._len = 0
+
+
 class ReplayBufferStorage:
     def __init__(self, data_specs, meta_specs, replay_dir):
         self._data_specs = data_specs
         self._meta_specs = meta_specs
         self._replay_dir = replay_dir
         replay_dir.mkdir(exist_ok=True)
-        self._current_episode = defaultdict(list)
+        # one episode in progress per env when fed from a vector env
+        self._current_episodes = dict()
         self._preload()
 
     def __len__(self):
         return self._num_transitions
 
-    def add(self, time_step, meta):
-        for key, value in meta.items():
-            self._current_episode[key].append(value)
-        for spec in self._data_specs:
-            value = time_step[spec.name]
-            if np.isscalar(value):
-                value = np.full(spec.shape, value, spec.dtype)
-            assert spec.shape == value.shape and spec.dtype == value.dtype
-            self._current_episode[spec.name].append(value)
+    def add(self, time_step, meta, env_idx=0):
+        if env_idx not in self._current_episodes:
+            self._current_episodes[env_idx] = EpisodeBuffer(
+                self._data_specs, self._meta_specs
+            )
+        current_episode = self._current_episodes[env_idx]
+        current_episode.add(time_step, meta)
         if time_step.last():
-            episode = dict()
-            for spec in self._data_specs:
-                value = self._current_episode[spec.name]
-                episode[spec.name] = np.array(value, spec.dtype)
-            for spec in self._meta_specs:
-                value = self._current_episode[spec.name]
-                episode[spec.name] = np.array(value, spec.dtype)
-            self._current_episode = defaultdict(list)
-            self._store_episode(episode)
+            # the episode is written out before its buffers are reused
+            self._store_episode(current_episode.episode())
+            current_episode.reset()
 
     def _preload(self):
         self._num_episodes = 0
@@ -113,6 +162,12 @@ class ReplayBuffer(IterableDataset):
         except:
             return False
         eps_len = episode_len(episode)
+        # the first episode of a staggered env can end before a single n-step
+        # transition fits into it
+        if eps_len < self._nstep:
+            if not self._save_snapshot:
+                eps_fn.unlink(missing_ok=True)
+            return True
         while eps_len + self._size > self._max_size:
             early_eps_fn = self._episode_fns.pop(0)
             early_eps = self._episodes.pop(early_eps_fn)
@@ -164,12 +219,11 @@ class ReplayBuffer(IterableDataset):
         obs = episode["observation"][idx - 1]
         action = episode["action"][idx]
         next_obs = episode["observation"][idx + self._nstep - 1]
-        reward = np.zeros_like(episode["reward"][idx])
-        discount = np.ones_like(episode["discount"][idx])
-        for i in range(self._nstep):
-            step_reward = episode["reward"][idx + i]
-            reward += discount * step_reward
-            discount *= episode["discount"][idx + i] * self._discount
+        reward, discount = _nstep_return(
+            episode["reward"][idx : idx + self._nstep],
+            episode["discount"][idx : idx + self._nstep],
+            np.float32(self._discount),
+        )
         return (obs, action, reward, discount, next_obs, *meta)
 
     def __iter__(self):
@@ -184,7 +238,14 @@ def _worker_init_fn(worker_id):
 
 
 def make_replay_loader(
-    storage, max_size, batch_size, num_workers, save_snapshot, nstep, discount
+    storage,
+    max_size,
+    batch_size,
+    num_workers,
+    save_snapshot,
+    nstep,
+    discount,
+    pin_memory=True,
 ):
     max_size_per_worker = max_size // max(1, num_workers)
 
@@ -202,7 +263,7 @@ def make_replay_loader(
         iterable,
         batch_size=batch_size,
         num_workers=num_workers,
-        pin_memory=True,
+        pin_memory=pin_memory,
         worker_init_fn=_worker_init_fn,
     )
     return loader
@@ -1,7 +1,13 @@
+import contextlib
+import copy
+import inspect
 import math
+import queue
 import random
 import re
+import threading
 import time
+import types
 
 import numpy as np
 import torch
@@ -36,6 +42,20 @@ def set_seed_everywhere(seed):
     random.seed(seed)
 
 
+def flatten_config(cfg):
+    # plain dict with nested keys joined by dots, e.g. "agent.lr"
+    def flatten(d, prefix=""):
+        flat = {}
+        for k, v in d.items():
+            if isinstance(v, dict):
+                flat.update(flatten(v, f"{prefix}{k}."))
+            else:
+                flat[f"{prefix}{k}"] = v
+        return flat
+
+    return flatten(OmegaConf.to_container(cfg, resolve=True))
+
+
 def chain(*iterables):
     for it in iterables:
         yield from it
@@ -51,6 +71,61 @@ def hard_update_params(net, target_net):
         target_param.data.copy_(param.data)
 
 
+def autocast(enabled, cache_enabled=True):
+    # bf16 autocast on cuda, needs torch >= 1.10 when enabled; the weight cast
+    # cache must be off around cuda graph capture and replay, or graphs keep
+    # reading cached casts that are freed when the context exits
+    if not enabled:
+        return contextlib.nullcontext()
+    return torch.autocast("cuda", dtype=torch.bfloat16, cache_enabled=cache_enabled)
+
+
+def compile_module(module, **kwargs):
+    # torch.compile is only available from torch 2.0 on
+    if hasattr(torch, "compile"):
+        return torch.compile(module, **kwargs)
+    return module
+
+
+def load_snapshot_payload(path):
+    # tensors stay on the host, agent.init_from copies them into the device
+    # params; mmap (torch >= 2.1) maps them from the file instead of reading it
+    kwargs = {}
+    if "mmap" in inspect.signature(torch.load).parameters:
+        # snapshots pickle whole agents, which weights_only loading rejects
+        kwargs.update(mmap=True, weights_only=False)
+    return torch.load(str(path), map_location="cpu", **kwargs)
+
+
+def host_copy(obj):
+    """Deep copy of obj with all of its tensors, including module parameters
+    and optimizer state, copied to host memory instead of on their device."""
+    memo, seen = dict(), set()
+
+    def visit(value):
+        if id(value) in seen or isinstance(value, (type, types.ModuleType)):
+            return
+        seen.add(id(value))
+        if isinstance(value, torch.Tensor):
+            copied = value.detach().to("cpu", copy=True)
+            if isinstance(value, nn.Parameter):
+                copied = nn.Parameter(copied, requires_grad=value.requires_grad)
+            # deepcopy picks these up instead of copying on the device
+            memo[id(value)] = copied
+        elif isinstance(value, dict):
+            for k, v in value.items():
+                visit(k)
+                visit(v)
+        elif isinstance(value, (list, tuple, set)):
+            for v in value:
+                visit(v)
+        elif hasattr(value, "__dict__"):
+            visit(vars(value))
+
+    visit(obj)
+    return copy.deepcopy(obj, memo)
+
+
 def to_torch(xs, device):
     return tuple(torch.as_tensor(x, device=device) for x in xs)
 
@@ -124,6 +199,182 @@ class Timer:
         return time.time() - self._start_time
 
 
+class PrefetchIterator:
+    """Pulls batches from a loader in a background thread and copies them to
+    the device on a side CUDA stream, keeping up to `num_prefetch` batches
+    ready ahead of the training loop. Host batches are staged in two reused
+    pinned buffers, so the loader itself does not need to pin memory."""
+
+    def __init__(self, loader, num_prefetch, device, num_slots=2):
+        self._device = torch.device(device)
+        self._stream = (
+            torch.cuda.Stream(self._device) if self._device.type == "cuda" else None
+        )
+        self._slots = [None] * num_slots
+        self._slot_events = [None] * num_slots
+        self._next_slot = 0
+        self._queue = queue.Queue(maxsize=num_prefetch)
+        self._thread = threading.Thread(
+            target=self._prefetch, args=(loader,), daemon=True
+        )
+        self._thread.start()
+
+    def _pin(self, batch):
+        i = self._next_slot
+        self._next_slot = (i + 1) % len(self._slots)
+        if self._slot_events[i] is not None:
+            # wait until the previous copy out of this slot has finished
+            self._slot_events[i].synchronize()
+        slot = self._slots[i]
+        if slot is None or any(s.shape != x.shape for s, x in zip(slot, batch)):
+            slot = tuple(
+                torch.empty(x.shape, dtype=x.dtype, pin_memory=True) for x in batch
+            )
+            self._slots[i] = slot
+        for s, x in zip(slot, batch):
+            s.copy_(x)
+        return i, slot
+
+    def _to_device(self, batch):
+        if self._stream is None:
+            return batch, None
+        i, slot = self._pin(batch)
+        with torch.cuda.stream(self._stream):
+            batch = tuple(x.to(self._device, non_blocking=True) for x in slot)
+            event = torch.cuda.Event()
+            event.record(self._stream)
+        self._slot_events[i] = event
+        return batch, event
+
+    def _prefetch(self, loader):
+        try:
+            for batch in loader:
+                self._queue.put(self._to_device(batch))
+        except Exception as e:
+            self._queue.put((e, None))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        batch, event = self._queue.get()
+        if isinstance(batch, Exception):
+            raise batch
+        if event is not None:
+            stream = torch.cuda.current_stream(self._device)
+            stream.wait_event(event)
+            for x in batch:
+                # the copy was allocated on the side stream
+                x.record_stream(stream)
+        return batch
+
+
+class CUDAGraphActor:
+    """Replays the actor forward pass from CUDA graphs, captured once per input
+    shape. Only the action mean is captured, the std is applied on replay."""
+
+    def __init__(self, actor, num_warmup=3):
+        self._actor = actor
+        self._num_warmup = num_warmup
+        self._graphs = dict()
+
+    def _capture(self, inpt):
+        static_inpt = inpt.clone()
+        # warm up on a side stream before capturing, as required by cuda graphs
+        stream = torch.cuda.Stream(inpt.device)
+        stream.wait_stream(torch.cuda.current_stream(inpt.device))
+        with torch.cuda.stream(stream):
+            for _ in range(self._num_warmup):
+                self._actor(static_inpt, 1.0)
+        torch.cuda.current_stream(inpt.device).wait_stream(stream)
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph):
+            static_mu = self._actor(static_inpt, 1.0).mean
+        return graph, static_inpt, static_mu
+
+    def __call__(self, inpt, std):
+        key = (inpt.shape, inpt.dtype)
+        if key not in self._graphs:
+            with torch.no_grad():
+                self._graphs[key] = self._capture(inpt)
+        graph, static_inpt, static_mu = self._graphs[key]
+        static_inpt.copy_(inpt)
+        graph.replay()
+        # copy out of the static buffer, upcasting if captured under autocast
+        mu = static_mu.to(torch.float32, copy=True)
+        return TruncatedNormal(mu, torch.ones_like(mu) * std)
+
+
+def graph_actor(actor):
+    # cuda graph capture is only available from torch 1.10 on, older versions
+    # keep running the actor eagerly
+    if hasattr(torch.cuda, "graph"):
+        return CUDAGraphActor(actor)
+    return actor
+
+
+def warmup_actor(agent, actor, obs_spec, batch_sizes, use_amp):
+    # compiles and captures the actor for each batch size before env steps
+    meta = agent.init_meta()
+    with torch.inference_mode(), eval_mode(agent), autocast(
+        use_amp, cache_enabled=False
+    ):
+        for batch_size in batch_sizes:
+            agent.act(
+                np.zeros((batch_size,) + obs_spec.shape, obs_spec.dtype),
+                {
+                    key: np.zeros((batch_size,) + value.shape, value.dtype)
+                    for key, value in meta.items()
+                },
+                0,
+                eval_mode=True,
+                actor=actor,
+            )
+
+
+def stagger_resets(envs, max_steps):
+    # resets a vector env and takes a random number of random-action steps in
+    # each env, so that their episodes do not run in lockstep
+    action_shape = envs.action_spec().shape
+    time_steps = envs.reset()
+    remaining = np.random.randint(0, max(1, max_steps), size=envs.num_envs)
+    while remaining.any():
+        indices = np.flatnonzero(remaining)
+        actions = np.random.uniform(
+            -1.0, 1.0, size=(len(indices),) + action_shape
+        ).astype(np.float32)
+        transitions = envs.step_and_maybe_reset(actions, indices)
+        for i, (_, next_time_step, _) in zip(indices, transitions):
+            time_steps[i] = next_time_step
+        remaining[indices] -= 1
+    return time_steps
+
+
+class MetricsBuffer:
+    def __init__(self):
+        self._metrics = []
+
+    def __len__(self):
+        return len(self._metrics)
+
+    def add(self, metrics):
+        # stored as floats, so no device tensors or graphs are kept alive
+        self._metrics.append(
+            {
+                k: v.item() if torch.is_tensor(v) else float(v)
+                for k, v in metrics.items()
+            }
+        )
+
+    def pop_mean(self):
+        keys = set().union(*self._metrics)
+        mean = {
+            key: np.mean([m[key] for m in self._metrics if key in m]) for key in keys
+        }
+        self._metrics = []
+        return mean
+
+
 class TruncatedNormal(pyd.Normal):
     def __init__(self, loc, scale, low=-1.0, high=1.0, eps=1e-6):
         super().__init__(loc, scale, validate_args=False)
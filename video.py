@@ -1,8 +1,85 @@
+import atexit
+import os
+import queue
+import tempfile
+import threading
+
 import cv2
 import imageio
 import numpy as np
 import wandb
 
+# writers whose encoder may still be running; at exit unsaved videos are
+# discarded and saved ones are finished
+_writers = []
+
+
+@atexit.register
+def _finish_writers():
+    for writer in _writers:
+        writer.close()
+        writer.join()
+
+
+class VideoWriter:
+    """Encodes frames into an mp4 in a background thread as they arrive, so
+    that neither recording nor saving waits on the encoder."""
+
+    def __init__(self, save_dir, fps):
+        fd, self._tmp_path = tempfile.mkstemp(suffix=".mp4", dir=save_dir)
+        os.close(fd)
+        os.chmod(self._tmp_path, 0o644)
+        self._path = None
+        self._error = None
+        self._closed = False
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._encode, args=(fps,), daemon=True)
+        self._thread.start()
+        _writers[:] = [writer for writer in _writers if writer._thread.is_alive()]
+        _writers.append(self)
+
+    def _encode(self, fps):
+        try:
+            writer = imageio.get_writer(self._tmp_path, fps=fps)
+            try:
+                while True:
+                    frame = self._queue.get()
+                    if frame is None:
+                        break
+                    writer.append_data(frame)
+            finally:
+                writer.close()
+        except Exception as e:
+            # raised again by the next append or close of the recording thread
+            self._error = e
+            os.remove(self._tmp_path)
+            return
+        if self._path is None:
+            os.remove(self._tmp_path)
+        else:
+            os.replace(self._tmp_path, self._path)
+
+    def _check_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def append(self, frame):
+        self._check_error()
+        self._queue.put(frame)
+
+    def close(self, path=None):
+        # the video is moved to path once encoded, or discarded without one
+        if self._closed:
+            return
+        if path is not None:
+            self._check_error()
+        self._closed = True
+        self._path = path
+        self._queue.put(None)
+
+    def join(self):
+        self._thread.join()
+
 
 class VideoRecorder:
     def __init__(self, root_dir, render_size=256, fps=20, camera_id=0, use_wandb=False):
@@ -15,12 +92,15 @@ class VideoRecorder:
         self.render_size = render_size
         self.fps = fps
         self.frames = []
+        self.writer = None
         self.camera_id = camera_id
         self.use_wandb = use_wandb
 
     def init(self, env, enabled=True):
         self.frames = []
         self.enabled = self.save_dir is not None and enabled
+        self.close()
+        self.writer = VideoWriter(self.save_dir, self.fps) if self.enabled else None
         self.record(env)
 
     def record(self, env):
@@ -33,7 +113,9 @@ class VideoRecorder:
                 )
             else:
                 frame = env.render()
-            self.frames.append(frame)
+            self.writer.append(frame)
+            if self.use_wandb:
+                self.frames.append(frame)
 
     def log_to_wandb(self):
         frames = np.transpose(np.array(self.frames), (0, 3, 1, 2))
@@ -47,11 +129,18 @@ class VideoRecorder:
         )
 
     def save(self, file_name):
-        if self.enabled:
+        if self.enabled and self.writer is not None:
             if self.use_wandb:
                 self.log_to_wandb()
             path = self.save_dir / file_name
-            imageio.mimsave(str(path), self.frames, fps=self.fps)
+            self.writer.close(str(path))
+            self.writer = None
+
+    def close(self):
+        # discards a video that was started but not saved
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
 
 
 class TrainVideoRecorder:
@@ -65,12 +154,15 @@ class TrainVideoRecorder:
         self.render_size = render_size
         self.fps = fps
         self.frames = []
+        self.writer = None
         self.camera_id = camera_id
         self.use_wandb = use_wandb
 
     def init(self, obs, enabled=True):
         self.frames = []
         self.enabled = self.save_dir is not None and enabled
+        self.close()
+        self.writer = VideoWriter(self.save_dir, self.fps) if self.enabled else None
         self.record(obs)
 
     def record(self, obs):
@@ -80,7 +172,9 @@ class TrainVideoRecorder:
                 dsize=(self.render_size, self.render_size),
                 interpolation=cv2.INTER_CUBIC,
             )
-            self.frames.append(frame)
+            self.writer.append(frame)
+            if self.use_wandb:
+                self.frames.append(frame)
 
     def log_to_wandb(self):
         frames = np.transpose(np.array(self.frames), (0, 3, 1, 2))
@@ -94,8 +188,15 @@ class TrainVideoRecorder:
         )
 
     def save(self, file_name):
-        if self.enabled:
+        if self.enabled and self.writer is not None:
             if self.use_wandb:
                 self.log_to_wandb()
             path = self.save_dir / file_name
-            imageio.mimsave(str(path), self.frames, fps=self.fps)
+            self.writer.close(str(path))
+            self.writer = None
+
+    def close(self):
+        # discards a video that was started but not saved
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None